@@ -1,22 +1,27 @@
 import os 
-import json 
+import asyncio
 import logging
 from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import Annotated, TypedDict, Sequence, List, Dict, Any
 from datetime import datetime
 
 import asyncpg 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+import httpx
+import orjson
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query
 from pydantic import BaseModel
 
 
 # LangChain / LangGraph Imports
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg.errors import DuplicateObject, DuplicateTable, UniqueViolation
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 
 
 from dotenv import load_dotenv
@@ -25,17 +30,37 @@ load_dotenv()
 # --- Configuration ---
 # 1. Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL") 
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "50"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+# Server-side prepared statements: prepare checkpoint queries on first use and keep
+# up to DB_PREPARED_MAX per connection. Use "none" behind PgBouncer transaction pooling.
+_prepare_threshold = os.getenv("DB_PREPARE_THRESHOLD", "0")
+DB_PREPARE_THRESHOLD = None if _prepare_threshold.lower() == "none" else int(_prepare_threshold)
+DB_PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", "1024"))
 
 # 2.Openrouter Configuration
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 MODEL_NAME = os.getenv("MODEL_NAME")
 
+# 3. Conversation window kept in graph state (and sent to the model) per session
+MAX_STATE_MESSAGES = int(os.getenv("MAX_STATE_MESSAGES", "40"))
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Streamed tokens are coalesced into one frame until either limit is hit
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.02  # seconds
+
+# Pre-encoded end-of-stream frame sent after every WebSocket reply
+_COMPLETE = orjson.dumps({"type": "complete"})
+
 # --- Pydantic Models --- 
+# Outbound models are built with `model_construct` from values we already own;
+# only inbound `ChatRequest` goes through validation.
 class ChatRequest(BaseModel):
     message : str
     session_id : str
@@ -53,37 +78,146 @@ class HistoryResponse(BaseModel):
     session_id : str
     messages: List[MessageDto]
     
+# Maps LangChain message `type` to the role exposed by the API.
+_ROLE_MAP = {"ai": "assistant", "system": "system", "human": "user", "tool": "tool"}
+    
+@lru_cache(maxsize=4096)
+def _cfg(session_id: str) -> dict:
+    """Graph config for a session thread, cached for long-lived sessions (treat as read-only)."""
+    return {"configurable": {"thread_id": session_id}}
+    
 # --- State Definition ---
+def _append_trim(left: Sequence[BaseMessage], right: Sequence[BaseMessage]) -> List[BaseMessage]:
+    """'add_messages' merge that keeps only the last MAX_STATE_MESSAGES messages."""
+    merged = add_messages(left, right)
+    return merged[-MAX_STATE_MESSAGES:]
+
 class State(TypedDict):
-    # 'add_messages' handles deduplication and appending automatically
-    messages: Annotated[Sequence[BaseMessage], add_messages] 
+    # '_append_trim' appends like 'add_messages' but bounds the window kept in state
+    messages: Annotated[Sequence[BaseMessage], _append_trim] 
+
+# --- Model (built once, shared by every request) ---
+# One pooled HTTP/2 client keeps TLS sessions to OpenRouter warm across chats.
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+
+_LLM = ChatOpenAI(
+    model=MODEL_NAME,
+    api_key=OPENROUTER_API_KEY,
+    base_url=OPENROUTER_BASE_URL,
+    temperature=0.7,
+    streaming=True,
+    http_async_client=_HTTP)
+
+# Constant system prompt, prepended directly instead of rendering a template per turn
+_SYSTEM = SystemMessage(content="You are helpful AI assistant. Answer concisely.")
+
+# --- History Projection ---
+# The checkpoint stays authoritative for graph state; this table is a flat,
+# append-only copy of every turn so history reads don't deserialize checkpoints.
+_CREATE_MESSAGES_SQL = """
+CREATE TABLE IF NOT EXISTS messages (
+    id BIGSERIAL PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS messages_session_created_at_idx
+    ON messages (session_id, created_at, id);
+"""
+
+_INSERT_MESSAGE_SQL = """
+INSERT INTO messages (session_id, role, content, created_at) VALUES (%s, %s, %s, now())
+"""
+
+_SELECT_MESSAGES_SQL = """
+SELECT role, content, created_at FROM messages
+WHERE session_id = %s
+ORDER BY created_at, id
+LIMIT %s OFFSET %s
+"""
+
+async def _insert_turn(conn, session_id: str, messages: Sequence[BaseMessage]):
+    """Insert a finished turn (user message + reply) into the history projection."""
+    rows = [(session_id, _ROLE_MAP.get(msg.type, "user"), msg.content) for msg in messages]
+    async with conn.cursor() as cur:
+        await cur.executemany(_INSERT_MESSAGE_SQL, rows)
+
+# --- Turn Ordering ---
+# A transaction-scoped advisory lock keyed on the session orders each turn after the
+# previous one, across sockets and worker processes. It is transaction-scoped (not
+# session-scoped) so it also holds behind PgBouncer.
+_TURN_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtextextended(%s, 0))"
+
+@asynccontextmanager
+async def _locked_turn(session_id: str):
+    """Hold the session's turn lock for one transaction; yields its connection."""
+    async with app.state.pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute(_TURN_LOCK_SQL, (session_id,))
+            yield conn
+
+def _bind_graph(conn):
+    """The compiled graph with its checkpointer bound to `conn` (and its transaction)."""
+    return app.state.graph.copy(update={"checkpointer": AsyncPostgresSaver(conn)})
+
+# --- Streamed Turns ---
+# A streamed turn's DB work runs in one background task and one transaction: lock,
+# read history, then (once the client already has its reply) write the checkpoint
+# and projection and commit. The client never waits on the write.
+_TURN_TASKS = set()
+
+async def _run_streamed_turn(session_id: str, history: asyncio.Future, turn: asyncio.Future):
+    """Lock the session, resolve `history`, then persist the messages `turn` resolves to."""
+    try:
+        async with _locked_turn(session_id) as conn:
+            graph = _bind_graph(conn)
+            checkpoint = await graph.checkpointer.aget_tuple(_cfg(session_id))
+            history.set_result(
+                checkpoint.checkpoint["channel_values"].get("messages", []) if checkpoint else []
+            )
+            
+            messages = await turn
+            if messages is None:
+                # Reply was never completed; release the lock without writing
+                return
+            await graph.aupdate_state(_cfg(session_id), {"messages": messages}, as_node="chatbot")
+            await _insert_turn(conn, session_id, messages)
+    except Exception as e:
+        if not history.done():
+            history.set_exception(e)
+        else:
+            logger.error(f"Failed to persist turn for {session_id}: {e}", exc_info=True)
+
+async def _start_streamed_turn(session_id: str):
+    """Start a streamed turn; returns its history and the future to resolve with the turn."""
+    loop = asyncio.get_running_loop()
+    history = loop.create_future()
+    turn = loop.create_future()
+    task = asyncio.create_task(_run_streamed_turn(session_id, history, turn))
+    _TURN_TASKS.add(task)
+    task.add_done_callback(_TURN_TASKS.discard)
+    try:
+        return await history, turn
+    except BaseException:
+        turn.cancel()
+        raise
 
 # --- Graph Construction ---
 def build_graph():
     """Build The LangGraph Structure (Nodes and Edge)"""
     
-    # 1. Initialize Model
-    llm = ChatOpenAI(
-        model=MODEL_NAME,
-        api_key=OPENROUTER_API_KEY,
-        base_url=OPENROUTER_BASE_URL,
-        temperature=0.7,
-        streaming=True)
-    
-    # 2. Define Logic
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are helpful AI assistant. Answer concisely."),
-        MessagesPlaceholder(variable_name="messages")
-    ])
-    
-    chain = prompt | llm
-    
-    # 3. Define Node 
+    # 1. Define Node 
     async def generate_response(state: State):
-        response = await chain.ainvoke(state["messages"])
-        return {"messages":[AIMessage(content=response.content)]}
+        # The reply is an AIMessage, so keep it as-is (usage/response metadata included).
+        response = await _LLM.ainvoke([_SYSTEM, *state["messages"]])
+        return {"messages":[response]}
     
-    # 4. Define Edges (Simple Linear Flow)
+    # 2. Define Edges (Simple Linear Flow)
     graph = StateGraph(State)
     graph.add_node("chatbot", generate_response)
     graph.add_edge(START, "chatbot")
@@ -92,26 +226,68 @@ def build_graph():
     return graph
     
 # --- FastAPI Lifespan (connection Management) ---
+async def _configure_connection(conn):
+    """Let each pooled connection keep its prepared checkpoint statements for its lifetime."""
+    conn.prepared_max = DB_PREPARED_MAX
+
+async def _setup_schema(pool, checkpointer, attempts: int = 3):
+    """Create checkpoint and history tables; retried since every worker runs it at startup."""
+    for attempt in range(1, attempts + 1):
+        try:
+            await checkpointer.setup()
+            async with pool.connection() as conn:
+                await conn.execute(_CREATE_MESSAGES_SQL, prepare=False)
+            return
+        except (UniqueViolation, DuplicateTable, DuplicateObject) as e:
+            # Concurrent DDL from another worker surfaces as duplicate-object errors
+            if attempt == attempts:
+                raise
+            logger.warning(f"Schema setup raced another worker, retrying: {e}")
+            await asyncio.sleep(0.5 * attempt)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting up: Connecting to Database...")
     
+    # Shared connection pool so concurrent sessions don't queue on one connection.
+    pool = AsyncConnectionPool(
+        conninfo=DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_idle=DB_POOL_MAX_IDLE,
+        kwargs={
+            "autocommit": True,
+            "prepare_threshold": DB_PREPARE_THRESHOLD,
+            "row_factory": dict_row,
+        },
+        configure=_configure_connection,
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+    
     try:
-        async with AsyncPostgresSaver.from_conn_string(DATABASE_URL) as checkpointer:
-            await checkpointer.setup()
-            logger.info("Checkpointer setup complete")
-            
-            workflow = build_graph()
-            app.state.graph = workflow.compile(checkpointer=checkpointer)
-            
-            logger.info("Application startup complete")
-            yield
+        await pool.open(wait=True)
+        app.state.pool = pool
+        
+        checkpointer = AsyncPostgresSaver(pool)
+        await _setup_schema(pool, checkpointer)
+        logger.info("Checkpointer setup complete")
+        
+        workflow = build_graph()
+        app.state.graph = workflow.compile(checkpointer=checkpointer)
+        
+        logger.info("Application startup complete")
+        yield
             
     except Exception as e:
         logger.error(f"Failed to start application: {e}", exc_info=True)
         raise
     finally:
         logger.info("Shutting down")
+        if _TURN_TASKS:
+            await asyncio.gather(*_TURN_TASKS, return_exceptions=True)
+        await pool.close()
+        await _HTTP.aclose()
     
 app = FastAPI(title="LangGraph Chatbot API" , lifespan=lifespan)
 
@@ -123,42 +299,124 @@ async def websocket_chat(websocket: WebSocket, session_id: str):
     Websocket endpoint that streams OpenRouter tokens in real-time.
     """
     await websocket.accept()
-    graph = app.state.graph
-    config = {"configurable": {"thread_id" :session_id}}
+    loop = asyncio.get_running_loop()
+    
+    async def flush(buf):
+        await websocket.send_bytes(orjson.dumps({
+            "type" : "token",
+            "content" : "".join(buf)
+        }))
+        buf.clear()
     
     try:
-        while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+        # iter_text() ends cleanly when the client disconnects
+        async for data in websocket.iter_text():
+            message_data = orjson.loads(data)
             user_text = message_data.get("message")
             
             if not user_text:
                 continue
             
-            # Stream events from the graph
-            async for event in graph.astream_events(
-                {"messages": [HumanMessage(content=user_text)]},
-                config = config,
-                version = "v2"
-            ):
-                kind = event["event"]
-                # Stream actual tokens from the OpenRouter model
-                if kind == "on_chat_model_stream":
-                    content = event["data"]["chunk"].content
+            user_message = HumanMessage(content=user_text)
+            reply = []
+            
+            # Buffer sub-word tokens so each frame carries a few of them
+            buf = []
+            buf_len = 0
+            last_flush = loop.time()
+            
+            # Locks the session (waiting out an earlier turn on any worker) and reads
+            # its history in one transaction that stays open until this turn is written
+            history, turn = await _start_streamed_turn(session_id)
+            
+            try:
+                # Stream tokens straight from the OpenRouter model
+                async for chunk in _LLM.astream([_SYSTEM, *history, user_message]):
+                    content = chunk.content
                     if content:
-                        await websocket.send_json({
-                            "type" : "token",
-                            "content" : content
-                        })
-                        
-            await websocket.send_json({"type":"complete"})
+                        reply.append(content)
+                        buf.append(content)
+                        buf_len += len(content)
+                        now = loop.time()
+                        if buf_len >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                            await flush(buf)
+                            buf_len = 0
+                            last_flush = now
+                            
+                if buf:
+                    await flush(buf)
+                await websocket.send_bytes(_COMPLETE)
+                # Persisted in the background; the lock stays held until it commits
+                turn.set_result([user_message, AIMessage(content="".join(reply))])
+            finally:
+                if not turn.done():
+                    turn.set_result(None)
+        logger.info(f"Client disconnected: {session_id}")
     except WebSocketDisconnect:
+        # Client went away mid-reply
         logger.info(f"Client disconnected: {session_id}")
     except Exception as e:
         logger.error(f"Websocket error: {e}")
         await websocket.close()
         
         
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest):
+    """
+    Non-streaming chat endpoint, returns the full reply in one response.
+    """
+    config = _cfg(request.session_id)
+    
+    try:
+        user_message = HumanMessage(content=request.message)
+        # Same pattern as streamed turns: the checkpoint and the history projection
+        # are written in one transaction under the session's turn lock
+        async with _locked_turn(request.session_id) as conn:
+            result = await _bind_graph(conn).ainvoke(
+                {"messages": [user_message]},
+                config = config
+            )
+            response = result["messages"][-1]
+            await _insert_turn(conn, request.session_id, [user_message, response])
+        return ChatResponse.model_construct(
+            response=response.content,
+            session_id=request.session_id
+        )
+    except Exception as e:
+        logger.error(f"Chat error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/conversation/{session_id}/history", response_model=HistoryResponse)
+async def get_history(
+    session_id: str,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Return a page of a session's message history, oldest first.
+    """
+    try:
+        async with app.state.pool.connection() as conn:
+            cur = await conn.execute(_SELECT_MESSAGES_SQL, (session_id, limit, offset))
+            rows = await cur.fetchall()
+        
+        formatted_messages = [
+            MessageDto.model_construct(
+                role=row["role"],
+                content=row["content"],
+                timestamp=row["created_at"].isoformat()
+            )
+            for row in rows
+        ]
+            
+        return HistoryResponse.model_construct(session_id=session_id, messages=formatted_messages)
+    except Exception as e:
+        logger.error(f"History error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+        
+        
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "database": "connected"}
\ No newline at end of file
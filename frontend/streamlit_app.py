@@ -1,18 +1,31 @@
 import streamlit as st
 import asyncio
+import threading
 import websockets
-import json
+import orjson
 import uuid
+from collections import OrderedDict
 import os
+import time
 from datetime import datetime
 from typing import List, Dict, Any
 
 # --- Configuration ---
 WEBSOCKET_URL = os.getenv("WEBSOCKET_URL", "ws://localhost:8000/ws/chat")
+# Re-render the streaming reply at most every RENDER_INTERVAL seconds or RENDER_EVERY tokens
+RENDER_INTERVAL = 0.05
+RENDER_EVERY = 16
+# Keep only the most recently used sessions, each with a bounded message list
+MAX_SESSIONS = 64
+MAX_SESSION_MESSAGES = 200
+# Close a chat's WebSocket once it has sat unused this long (seconds); browser sessions
+# that go away never close theirs, and the shared loop would keep them alive forever
+WS_IDLE_TIMEOUT = 120
 
 # --- Initialize Session State ---
 if "sessions" not in st.session_state:
-    st.session_state.sessions = {}
+    # Ordered by last use: oldest first, most recent last
+    st.session_state.sessions = OrderedDict()
     
 if "current_session_id" not in st.session_state:
     session_id = str(uuid.uuid4())
@@ -23,48 +36,136 @@ if "current_session_id" not in st.session_state:
         "created_at": datetime.now().isoformat()
     }
 
+# --- WebSocket Connections ---
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Background event loop created once per server process and shared by all browser sessions.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+class WebSocketClient:
+    """
+    Keeps one open WebSocket per chat session, driven by the shared background loop.
+    """
+    
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.connections: Dict[str, Any] = {}
+        self.idle_timers: Dict[str, asyncio.TimerHandle] = {}
+        
+    def run(self, coro):
+        """Run a coroutine on the background loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    
+    async def send(self, session_id: str, payload: str):
+        """Send on the session's open connection, (re)connecting if needed."""
+        self._cancel_idle_timer(session_id)
+        websocket = self.connections.get(session_id)
+        if websocket is not None and websocket.close_code is None:
+            try:
+                await websocket.send(payload)
+                return websocket
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            
+        websocket = await websockets.connect(
+            f"{WEBSOCKET_URL}/{session_id}",
+            ping_interval=30,
+            ping_timeout=60,
+            close_timeout=10
+        )
+        self.connections[session_id] = websocket
+        await websocket.send(payload)
+        return websocket
+    
+    async def release(self, session_id: str):
+        """Mark the session's connection idle; it is closed unless reused within WS_IDLE_TIMEOUT."""
+        websocket = self.connections.get(session_id)
+        if websocket is not None:
+            self._cancel_idle_timer(session_id)
+            self.idle_timers[session_id] = self.loop.call_later(
+                WS_IDLE_TIMEOUT, self._close_if_idle, session_id, websocket
+            )
+    
+    def _close_if_idle(self, session_id: str, websocket):
+        # Runs on the loop: a send since release() would have cancelled this timer, and
+        # the connection is detached synchronously so a later send opens a new one
+        self.idle_timers.pop(session_id, None)
+        if self.connections.get(session_id) is websocket:
+            del self.connections[session_id]
+            self.loop.create_task(websocket.close())
+    
+    async def close(self, session_id: str):
+        self._cancel_idle_timer(session_id)
+        websocket = self.connections.pop(session_id, None)
+        if websocket is not None:
+            await websocket.close()
+    
+    def _cancel_idle_timer(self, session_id: str):
+        timer = self.idle_timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+
+if "ws_client" not in st.session_state:
+    st.session_state.ws_client = WebSocketClient(get_event_loop())
+
 # --- Helper Functions ---
-async def send_message_websocket(session_id: str, message: str, placeholder):
+def send_message_websocket(session_id: str, message: str, placeholder):
     """
-    Connect to WebSocket and stream the response.
+    Send over the session's persistent WebSocket and stream the response.
     """
+    client = st.session_state.ws_client
     uri = f"{WEBSOCKET_URL}/{session_id}"
-    full_response = ""
+    # Accumulate tokens in a list; join only when rendering
+    parts = []
     is_first_token = True
+    last_render = time.monotonic()
+    pending = 0
+    # Only a connection whose reply was read up to its complete marker can be reused
+    completed = False
     
     try:
-        async with websockets.connect(uri, ping_timeout=60, close_timeout=10) as websocket:
-            # Send user message
-            payload = json.dumps({"message": message})
-            await websocket.send(payload)
-            
-            # Show thinking indicator initially
-            placeholder.markdown("🤔 *Thinking...*")
-            
-            # Receive streaming response
-            while True:
-                try:
-                    response = await websocket.recv()
-                    data = json.loads(response)
+        # Send user message
+        # Sent as a text frame; the backend reads it with websocket.iter_text()
+        payload = orjson.dumps({"message": message}).decode()
+        websocket = client.run(client.send(session_id, payload))
+        
+        # Show thinking indicator initially
+        placeholder.markdown("🤔 *Thinking...*")
+        
+        # Receive streaming response
+        while True:
+            try:
+                response = client.run(websocket.recv())
+                data = orjson.loads(response)
+                
+                if data.get("type") == "token":
+                    content = data.get("content", "")
+                    
+                    # Clear thinking indicator on first real token
+                    if is_first_token and content.strip():
+                        is_first_token = False
                     
-                    if data.get("type") == "token":
-                        content = data.get("content", "")
-                        
-                        # Clear thinking indicator on first real token
-                        if is_first_token and content.strip():
-                            is_first_token = False
-                        
-                        full_response += content
-                        placeholder.markdown(full_response + "▌")
-                        
-                    elif data.get("type") == "complete":
-                        placeholder.markdown(full_response)
-                        break
-                        
-                except websockets.exceptions.ConnectionClosed:
+                    parts.append(content)
+                    pending += 1
+                    now = time.monotonic()
+                    if pending >= RENDER_EVERY or now - last_render > RENDER_INTERVAL:
+                        placeholder.markdown("".join(parts) + "▌")
+                        last_render = now
+                        pending = 0
+                    
+                elif data.get("type") == "complete":
+                    completed = True
+                    placeholder.markdown("".join(parts))
                     break
                     
-        return full_response
+            except websockets.exceptions.ConnectionClosed:
+                break
+                
+        return "".join(parts)
         
     except websockets.exceptions.InvalidStatusCode as e:
         error_msg = f"WebSocket connection failed with status {e.status_code}"
@@ -76,6 +177,13 @@ async def send_message_websocket(session_id: str, message: str, placeholder):
     except Exception as e:
         st.error(f"WebSocket error: {str(e)}\n\nConnection URL: {uri}")
         return None
+    finally:
+        # Also runs when Streamlit aborts the script (rerun/stop raise BaseException),
+        # so a half-read reply can't leak into the next turn
+        if completed:
+            client.run(client.release(session_id))
+        else:
+            client.run(client.close(session_id))
 
 def create_new_session():
     """Create a new chat session."""
@@ -86,10 +194,18 @@ def create_new_session():
         "created_at": datetime.now().isoformat()
     }
     st.session_state.current_session_id = session_id
+    
+    # Evict the least recently used sessions
+    sessions = st.session_state.sessions
+    client = st.session_state.ws_client
+    while len(sessions) > MAX_SESSIONS:
+        evicted_id, _ = sessions.popitem(last=False)
+        client.run(client.close(evicted_id))
     st.rerun()
 
 def switch_session(session_id: str):
     """Switch to a different session."""
+    st.session_state.sessions.move_to_end(session_id)
     st.session_state.current_session_id = session_id
     st.rerun()
 
@@ -98,6 +214,9 @@ def delete_session(session_id: str):
     if session_id in st.session_state.sessions:
         del st.session_state.sessions[session_id]
         
+    client = st.session_state.ws_client
+    client.run(client.close(session_id))
+        
     if st.session_state.current_session_id == session_id:
         create_new_session()
     else:
@@ -109,6 +228,17 @@ def update_session_title(session_id: str, first_message: str):
         title = first_message[:50] + "..." if len(first_message) > 50 else first_message
         st.session_state.sessions[session_id]["title"] = title
 
+def append_message(session: Dict[str, Any], role: str, content: str):
+    """Append a message to a session, keeping only the last MAX_SESSION_MESSAGES."""
+    messages = session["messages"]
+    messages.append({
+        "role": role,
+        "content": content,
+        "timestamp": datetime.now().isoformat()
+    })
+    if len(messages) > MAX_SESSION_MESSAGES:
+        del messages[:-MAX_SESSION_MESSAGES]
+
 # --- Sidebar ---
 with st.sidebar:
     st.title("💬 Chat Sessions")
@@ -121,13 +251,8 @@ with st.sidebar:
     
     st.divider()
     
-    sessions_sorted = sorted(
-        st.session_state.sessions.items(),
-        key=lambda x: x[1]["created_at"],
-        reverse=True
-    )
-    
-    for session_id, session_data in sessions_sorted:
+    # Most recently used first
+    for session_id, session_data in reversed(st.session_state.sessions.items()):
         col1, col2 = st.columns([4, 1])
         
         with col1:
@@ -163,11 +288,7 @@ with chat_container:
 
 # Chat input
 if prompt := st.chat_input("Type your message here..."):
-    current_session["messages"].append({
-        "role": "user",
-        "content": prompt,
-        "timestamp": datetime.now().isoformat()
-    })
+    append_message(current_session, "user", prompt)
     
     if len(current_session["messages"]) == 1:
         update_session_title(st.session_state.current_session_id, prompt)
@@ -178,20 +299,14 @@ if prompt := st.chat_input("Type your message here..."):
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
         
-        response = asyncio.run(
-            send_message_websocket(
-                st.session_state.current_session_id,
-                prompt,
-                message_placeholder
-            )
+        response = send_message_websocket(
+            st.session_state.current_session_id,
+            prompt,
+            message_placeholder
         )
         
         if response:
-            current_session["messages"].append({
-                "role": "assistant",
-                "content": response,
-                "timestamp": datetime.now().isoformat()
-            })
+            append_message(current_session, "assistant", response)
 
 # Footer
 st.divider()